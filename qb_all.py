@@ -0,0 +1,28 @@
+import qb_inv
+import qb_so
+import qb_po
+import qb_shipto
+from qb_session import qb_session
+
+def main():
+    """
+    Runs the invoice, sales order, purchase order and ship-to exports one after another
+    inside a single QuickBooks session, so the connection is only opened once.
+    """
+    try:
+        with qb_session("PythonQBExportAll") as (rp, session):
+            for title, export in [
+                ("Invoices", qb_inv.main),
+                ("Sales Orders", qb_so.main),
+                ("Purchase Orders", qb_po.main),
+                ("Ship-To Addresses", qb_shipto.main),
+            ]:
+                print(f"\n=== {title} ===")
+                export(rp, session)
+    except KeyboardInterrupt:
+        print("\nOperation cancelled by user.")
+    except Exception as e:
+        print("Error communicating with QuickBooks:", e)
+
+if __name__ == "__main__":
+    main()
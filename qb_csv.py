@@ -0,0 +1,16 @@
+import gzip
+from contextlib import contextmanager
+
+@contextmanager
+def open_csv(filename, compress=False):
+    """
+    Opens `filename` for CSV writing through a 1 MiB buffer. With `compress`, the text is
+    gzipped on the way out at level 1, which is cheap on CPU and shrinks repetitive CSV a lot.
+    """
+    if not compress:
+        with open(filename, "w", newline="", encoding="utf-8", buffering=1 << 20) as f:
+            yield f
+        return
+    with open(filename, "wb", buffering=1 << 20) as raw, \
+            gzip.open(raw, "wt", compresslevel=1, encoding="utf-8", newline="") as f:
+        yield f
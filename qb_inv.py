@@ -1,178 +1,180 @@
 import csv
-import xml.etree.ElementTree as ET
-import win32com.client
-import pythoncom
+import os
+import sys
+from contextlib import nullcontext
 from datetime import date
-
-def build_qbxml_invoice_request(invoice_number):
-    """InvoiceQuery filtered by a single invoice number."""
-    return (
-        '<?xml version="1.0" encoding="utf-8"?>\n'
-        '<?qbxml version="16.0"?>\n'
-        '<QBXML>\n'
-        '  <QBXMLMsgsRq onError="continueOnError">\n'
-        f'    <InvoiceQueryRq requestID="1">\n'
-        f'      <RefNumber>{invoice_number}</RefNumber>\n'
-        '      <IncludeLineItems>1</IncludeLineItems>\n'
-        '    </InvoiceQueryRq>\n'
-        '  </QBXMLMsgsRq>\n'
-        '</QBXML>'
-    )
+from qb_csv import open_csv
+from qb_session import qb_session
+from qb_xml import iter_records, child_text, parse_address
+from xml.sax.saxutils import escape
+
+# Set QB_DEBUG=1 to echo generated QBXML (e.g. for validation in qbValidator.exe)
+DEBUG = bool(os.environ.get("QB_DEBUG"))
+# Set QB_GZIP=1 to write exports as gzip-compressed .csv.gz files
+COMPRESS = bool(os.environ.get("QB_GZIP"))
+
+FIELDNAMES = (
+    "Invoice Number","Customer Name","Invoice Date","PO Number","Ship To",
+    "Line Description","Quantity","Rate","Amount","Item Ref Full Name"
+)
+
+# These scripts run once per invocation, so "today" is fixed at import
+_TODAY_ISO = date.today().isoformat()
+
+# Request envelopes are built once at import; builders only fill in the %s slots.
+_INVOICE_QUERY_TPL = (
+    '<?xml version="1.0" encoding="utf-8"?>\n'
+    '<?qbxml version="16.0"?>\n'
+    '<QBXML>\n'
+    '  <QBXMLMsgsRq onError="continueOnError">\n'
+    '    <InvoiceQueryRq requestID="1">\n'
+    '%s'
+    '      <IncludeLineItems>1</IncludeLineItems>\n'
+    '    </InvoiceQueryRq>\n'
+    '  </QBXMLMsgsRq>\n'
+    '</QBXML>'
+)
+
+_YEAR_INVOICE_QUERY_TPL = (
+    '<?xml version="1.0" encoding="utf-8"?>\n'
+    '<?qbxml version="16.0"?>\n'
+    '<QBXML>\n'
+    '  <QBXMLMsgsRq onError="continueOnError">\n'
+    '    <InvoiceQueryRq requestID="1">\n'
+    '      <TxnDateRangeFilter>\n'
+    '        <FromTxnDate>%s</FromTxnDate>\n'
+    '        <ToTxnDate>%s</ToTxnDate>\n'
+    '      </TxnDateRangeFilter>\n'
+    '      <IncludeLineItems>1</IncludeLineItems>\n'
+    '    </InvoiceQueryRq>\n'
+    '  </QBXMLMsgsRq>\n'
+    '</QBXML>'
+)
+
+def build_qbxml_invoice_request(invoice_numbers):
+    """InvoiceQuery filtered by one or more invoice numbers, answered in a single round-trip."""
+    ref_numbers = "".join(f'      <RefNumber>{escape(n)}</RefNumber>\n' for n in invoice_numbers)
+    return _INVOICE_QUERY_TPL % ref_numbers
 
 def build_qbxml_year_invoices_request(year):
     """
     InvoiceQueryRq that returns every invoice from Jan 1 of `year` through today,
     with line items included. Filter must appear before IncludeLineItems.
     """
-    from_date = f"{year}-01-01"
-    to_date   = date.today().isoformat()
-
-    qbxml = (
-        '<?xml version="1.0" encoding="utf-8"?>\n'
-        '<?qbxml version="16.0"?>\n'
-        '<QBXML>\n'
-        '  <QBXMLMsgsRq onError="continueOnError">\n'
-        '    <InvoiceQueryRq requestID="1">\n'
-        '      <TxnDateRangeFilter>\n'
-        f'        <FromTxnDate>{from_date}</FromTxnDate>\n'
-        f'        <ToTxnDate>{to_date}</ToTxnDate>\n'
-        '      </TxnDateRangeFilter>\n'
-        '      <IncludeLineItems>1</IncludeLineItems>\n'
-        '    </InvoiceQueryRq>\n'
-        '  </QBXMLMsgsRq>\n'
-        '</QBXML>'
-    )
-    print("DEBUG: Generated QBXML:\n", qbxml)  # for validation in qbValidator.exe
+    from_date = escape(f"{year}-01-01")
+    to_date   = _TODAY_ISO
+
+    qbxml = _YEAR_INVOICE_QUERY_TPL % (from_date, to_date)
+    if DEBUG:
+        print("DEBUG: Generated QBXML:\n", qbxml)  # for validation in qbValidator.exe
     return qbxml
 
-def parse_address(address_element):
-    if address_element is None:
-        return ""
-    parts = []
-    for tag in ["Addr1","Addr2","Addr3","Addr4","Addr5","City","State","PostalCode","Country"]:
-        text = address_element.findtext(tag, "").strip()
-        if text:
-            parts.append(text)
-    return ", ".join(parts)
-
-def process_invoice_response(response_xml):
-    root = ET.fromstring(response_xml)
-    data = []
-
-    for inv in root.findall('.//InvoiceRet'):
+def iter_invoice_rows(response_xml):
+    for inv in iter_records(response_xml, 'InvoiceRet'):
+        # Index the children in one pass; line items are the only repeated child
+        fields = {}
+        line_items = []
+        for child in inv:
+            if child.tag == 'InvoiceLineRet':
+                line_items.append(child)
+            else:
+                fields[child.tag] = child
+
         # Header fields
-        invoice_number = inv.findtext('RefNumber', "")
-        invoice_date   = inv.findtext('TxnDate',   "")
-        po_number      = inv.findtext('PONumber',  "")
-        customer_elem  = inv.find('CustomerRef')
+        invoice_number = child_text(fields, 'RefNumber')
+        invoice_date   = child_text(fields, 'TxnDate')
+        po_number      = child_text(fields, 'PONumber')
+        customer_elem  = fields.get('CustomerRef')
         if customer_elem is not None:
             customer_name = customer_elem.findtext('FullName', "")
         else:
             customer_name = ""
 
-        ship_address = parse_address(inv.find('ShipAddress'))
+        ship_address = parse_address(fields.get('ShipAddress'))
+
+        # The same customers, addresses and dates recur across invoices; intern them so
+        # rows held in memory share one copy of each string
+        customer_name = sys.intern(customer_name)
+        ship_address  = sys.intern(ship_address)
+        invoice_date  = sys.intern(invoice_date)
 
         # Line items
-        line_items = inv.findall('InvoiceLineRet')
         if not line_items:
-            data.append({
-                "Invoice Number": invoice_number,
-                "Customer Name":  customer_name,
-                "Invoice Date":   invoice_date,
-                "PO Number":      po_number,
-                "Ship To":        ship_address,
-                "Line Description": "",
-                "Quantity":         "",
-                "Rate":             "",
-                "Amount":           "",
-                "Item Ref Full Name": ""
-            })
+            yield (
+                invoice_number, customer_name, invoice_date, po_number, ship_address,
+                "", "", "", "", ""
+            )
         else:
             for li in line_items:
-                line_desc     = li.findtext('Desc',     "")
-                quantity      = li.findtext('Quantity',"")
-                rate          = li.findtext('Rate',     "")
-                amount        = li.findtext('Amount',   "")
-                item_ref_elem = li.find('ItemRef')
+                li_fields     = {c.tag: c for c in li}
+                line_desc     = child_text(li_fields, 'Desc')
+                quantity      = child_text(li_fields, 'Quantity')
+                rate          = child_text(li_fields, 'Rate')
+                amount        = child_text(li_fields, 'Amount')
+                item_ref_elem = li_fields.get('ItemRef')
                 if item_ref_elem is not None:
                     item_full_name = item_ref_elem.findtext('FullName', "")
                 else:
                     item_full_name = ""
 
-                data.append({
-                    "Invoice Number": invoice_number,
-                    "Customer Name":  customer_name,
-                    "Invoice Date":   invoice_date,
-                    "PO Number":      po_number,
-                    "Ship To":        ship_address,
-                    "Line Description": line_desc,
-                    "Quantity":         quantity,
-                    "Rate":             rate,
-                    "Amount":           amount,
-                    "Item Ref Full Name": item_full_name
-                })
-
-    return data
-
-def export_to_csv(data, filename):
-    fieldnames = [
-        "Invoice Number","Customer Name","Invoice Date","PO Number","Ship To",
-        "Line Description","Quantity","Rate","Amount","Item Ref Full Name"
-    ]
-    with open(filename, "w", newline="", encoding="utf-8") as f:
-        writer = csv.DictWriter(f, fieldnames=fieldnames)
-        writer.writeheader()
-        writer.writerows(data)
+                yield (
+                    invoice_number, customer_name, invoice_date, po_number, ship_address,
+                    line_desc, quantity, rate, amount, item_full_name
+                )
+
+def export_to_csv(rows, filename, compress=COMPRESS):
+    if compress:
+        filename += ".gz"
+    with open_csv(filename, compress) as f:
+        writer = csv.writer(f)
+        writer.writerow(FIELDNAMES)
+        writer.writerows(rows)
     print(f"Export complete! Data saved to {filename}")
 
-def main():
+def main(rp=None, session=None):
+    """
+    Runs the invoice export. Pass an open (rp, session) from qb_session to reuse an
+    existing QuickBooks session; otherwise one is opened and closed here.
+    Ctrl+C is passed on to the caller when the session was handed in.
+    """
     choice = input("Fetch by invoice numbers (n) or by year (y)? ").strip().lower()
 
-    rp = None
-    session = None
+    owns_session = rp is None
     try:
-        pythoncom.CoInitialize()
-        rp = win32com.client.Dispatch("QBXMLRP2.RequestProcessor")
-        rp.OpenConnection("", "PythonInvoiceQBXMLApp")
-        session = rp.BeginSession("", 2)
-
-        if choice == 'y':
-            year = input("Enter year (e.g. 2023): ").strip()
-            qbxml_request = build_qbxml_year_invoices_request(year)
-            print(f"\nSending QBXML Request for invoices from {year}-01-01 through today...")
-            response = rp.ProcessRequest(session, qbxml_request)
-            data = process_invoice_response(response)
-            export_to_csv(data, filename=f"invoices_from_{year}.csv")
-
-        elif choice == 'n':
-            inv_input = input("Enter comma-separated invoice numbers: ").strip()
-            invoice_numbers = [i.strip() for i in inv_input.split(",") if i.strip()]
-            if not invoice_numbers:
-                print("No invoice numbers provided; exiting.")
-            else:
-                for inv in invoice_numbers:
-                    qbxml_request = build_qbxml_invoice_request(inv)
-                    print(f"\nSending QBXML Request for Invoice {inv}...")
+        with (qb_session("PythonInvoiceQBXMLApp") if rp is None else nullcontext((rp, session))) as (rp, session):
+            if choice == 'y':
+                year = input("Enter year (e.g. 2023): ").strip()
+                qbxml_request = build_qbxml_year_invoices_request(year)
+                print(f"\nSending QBXML Request for invoices from {year}-01-01 through today...")
+                response = rp.ProcessRequest(session, qbxml_request)
+                export_to_csv(iter_invoice_rows(response), filename=f"invoices_from_{year}.csv")
+
+            elif choice == 'n':
+                inv_input = input("Enter comma-separated invoice numbers: ").strip()
+                invoice_numbers = [i.strip() for i in inv_input.split(",") if i.strip()]
+                if not invoice_numbers:
+                    print("No invoice numbers provided; exiting.")
+                else:
+                    qbxml_request = build_qbxml_invoice_request(invoice_numbers)
+                    print(f"\nSending QBXML Request for {len(invoice_numbers)} invoice(s)...")
                     response = rp.ProcessRequest(session, qbxml_request)
-                    data = process_invoice_response(response)
-                    export_to_csv(data, filename=f"invoice_{inv}.csv")
 
-        else:
-            print("Invalid choice; please run again and enter 'n' or 'y'.")
+                    # QuickBooks matches RefNumber case-insensitively, so group the same way
+                    rows_by_invoice = {}
+                    for row in iter_invoice_rows(response):
+                        rows_by_invoice.setdefault(row[0].casefold(), []).append(row)
+                    for inv in invoice_numbers:
+                        export_to_csv(rows_by_invoice.get(inv.casefold(), []), filename=f"invoice_{inv}.csv")
+
+            else:
+                print("Invalid choice; please run again and enter 'n' or 'y'.")
 
     except KeyboardInterrupt:
+        if not owns_session:
+            raise  # let the caller (e.g. qb_all) stop the whole run, not just this export
         print("\nOperation cancelled by user.")
     except Exception as e:
         print("Error communicating with QuickBooks:", e)
-    finally:
-        # clean up COM session—even if errors or Ctrl+C
-        if rp and session:
-            try: rp.EndSession(session)
-            except: pass
-        if rp:
-            try: rp.CloseConnection()
-            except: pass
-        pythoncom.CoUninitialize()
 
 if __name__ == "__main__":
     main()
@@ -1,67 +1,93 @@
 import csv
-import xml.etree.ElementTree as ET
-import win32com.client
-import pythoncom
+import os
+import queue
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import nullcontext
+from itertools import chain
 from datetime import date
+from qb_csv import open_csv
+from qb_session import qb_session
+from qb_xml import iter_records, child_text, parse_address
+from xml.sax.saxutils import escape
+
+# Set QB_DEBUG=1 to echo generated QBXML (e.g. for validation in qbValidator.exe)
+DEBUG = bool(os.environ.get("QB_DEBUG"))
+# Set QB_GZIP=1 to write exports as gzip-compressed .csv.gz files
+COMPRESS = bool(os.environ.get("QB_GZIP"))
+
+FIELDNAMES = (
+    "PO Number","Vendor Name","Transaction Date","Due Date","Vendor Address","Ship To",
+    "Total Amount","Line Description","Quantity","Rate","Amount","Item Ref Full Name"
+)
+
+# POs per QuickBooks request when fetching by number; the next batch is requested while
+# the previous one is parsed and written
+_PO_BATCH_SIZE = 50
+
+# These scripts run once per invocation, so "today" is fixed at import
+_TODAY_ISO = date.today().isoformat()
+
+# Request pieces are built once at import; builders fill in the %s slots of the query
+# bodies and join them between the fixed envelope.
+_ENVELOPE_OPEN = (
+    '<?xml version="1.0" encoding="utf-8"?>\n'
+    '<?qbxml version="16.0"?>\n'
+    '<QBXML>\n'
+    '  <QBXMLMsgsRq onError="continueOnError">\n'
+)
+_ENVELOPE_CLOSE = (
+    '  </QBXMLMsgsRq>\n'
+    '</QBXML>'
+)
+
+_PO_QUERY_TPL = (
+    '    <PurchaseOrderQueryRq requestID="%d">\n'
+    '      <RefNumber>%s</RefNumber>\n'
+    '      <IncludeLineItems>1</IncludeLineItems>\n'
+    '    </PurchaseOrderQueryRq>\n'
+)
+
+_YEAR_PO_QUERY_TPL = (
+    '    <PurchaseOrderQueryRq requestID="1">\n'
+    '      <TxnDateRangeFilter>\n'
+    '        <FromTxnDate>%s</FromTxnDate>\n'
+    '        <ToTxnDate>%s</ToTxnDate>\n'
+    '      </TxnDateRangeFilter>\n'
+    '      <IncludeLineItems>1</IncludeLineItems>\n'
+    '    </PurchaseOrderQueryRq>\n'
+)
 
 def build_qbxml_po_request(po_number):
     """PurchaseOrderQuery filtered by a single PO number."""
-    return (
-        '<?xml version="1.0" encoding="utf-8"?>\n'
-        '<?qbxml version="16.0"?>\n'
-        '<QBXML>\n'
-        '  <QBXMLMsgsRq onError="continueOnError">\n'
-        f'    <PurchaseOrderQueryRq requestID="1">\n'
-        f'      <RefNumber>{po_number}</RefNumber>\n'
-        '      <IncludeLineItems>1</IncludeLineItems>\n'
-        '    </PurchaseOrderQueryRq>\n'
-        '  </QBXMLMsgsRq>\n'
-        '</QBXML>'
-    )
+    return build_qbxml_multi_po_request([po_number])
+
+def build_qbxml_multi_po_request(po_numbers):
+    """
+    One PurchaseOrderQueryRq per PO number, all inside a single QBXMLMsgsRq so QuickBooks
+    answers them in one round-trip. requestIDs count up from 1 in the order given; with
+    continueOnError a PO that is not found does not stop the others.
+    """
+    queries = (_PO_QUERY_TPL % (i, escape(n)) for i, n in enumerate(po_numbers, 1))
+    return "".join((_ENVELOPE_OPEN, *queries, _ENVELOPE_CLOSE))
 
 def build_qbxml_year_po_request(year):
     """
     PurchaseOrderQueryRq that returns every PO from Jan 1 of `year` through today,
     with line items included. Filter must appear before IncludeLineItems.
     """
-    from_date = f"{year}-01-01"
-    to_date   = date.today().isoformat()
-
-    qbxml = (
-        '<?xml version="1.0" encoding="utf-8"?>\n'
-        '<?qbxml version="16.0"?>\n'
-        '<QBXML>\n'
-        '  <QBXMLMsgsRq onError="continueOnError">\n'
-        '    <PurchaseOrderQueryRq requestID="1">\n'
-        '      <TxnDateRangeFilter>\n'
-        f'        <FromTxnDate>{from_date}</FromTxnDate>\n'
-        f'        <ToTxnDate>{to_date}</ToTxnDate>\n'
-        '      </TxnDateRangeFilter>\n'
-        '      <IncludeLineItems>1</IncludeLineItems>\n'
-        '    </PurchaseOrderQueryRq>\n'
-        '  </QBXMLMsgsRq>\n'
-        '</QBXML>'
-    )
-    print("DEBUG: Generated QBXML:\n", qbxml)  # for validation in qbValidator.exe
+    from_date = escape(f"{year}-01-01")
+    to_date   = _TODAY_ISO
+
+    qbxml = "".join((_ENVELOPE_OPEN, _YEAR_PO_QUERY_TPL % (from_date, to_date), _ENVELOPE_CLOSE))
+    if DEBUG:
+        print("DEBUG: Generated QBXML:\n", qbxml)  # for validation in qbValidator.exe
     return qbxml
 
-def parse_address(address_element):
-    """
-    Helper function to parse an address block from QBXML.
-    Concatenates common address fields (for example, Addr1, City, State, etc.) into a single string.
+def iter_po_rows(response_xml):
     """
-    if address_element is None:
-        return ""
-    parts = []
-    for tag in ["Addr1", "Addr2", "Addr3", "Addr4", "Addr5", "City", "State", "PostalCode", "Country"]:
-        text = address_element.findtext(tag, "").strip()
-        if text:
-            parts.append(text)
-    return ", ".join(parts)
-
-def process_po_response(response_xml):
-    """
-    Parses the QBXML response for purchase orders and returns a list of dictionaries for CSV export.
+    Parses the QBXML response for purchase orders and yields one tuple per CSV row, in column order.
+    Rows are produced as each PurchaseOrderRet is parsed, so they can be written out without collecting them first.
 
     For each purchase order (PurchaseOrderRet element) extracted, it collects header information:
       - Purchase Order Number (RefNumber)
@@ -81,163 +107,184 @@ def process_po_response(response_xml):
 
     If no line items are found, a single row is created with blank details for the line items.
     """
-    root = ET.fromstring(response_xml)
-    pos = root.findall('.//PurchaseOrderRet')
-    data = []
-    
-    for po in pos:
+    for po in iter_records(response_xml, 'PurchaseOrderRet'):
+        # Index the children in one pass, splitting out simple and grouped line items
+        fields = {}
+        line_items = []
+        group_items = []
+        for child in po:
+            if child.tag == 'PurchaseOrderLineRet':
+                line_items.append(child)
+            elif child.tag == 'PurchaseOrderLineGroupRet':
+                group_items.append(child)
+            else:
+                fields[child.tag] = child
+
         # Header fields
-        po_number = po.findtext('RefNumber', default="")
-        txn_date = po.findtext('TxnDate', default="")
-        due_date = po.findtext('DueDate', default="")
-        vendor_elem = po.find('VendorRef')
+        po_number = child_text(fields, 'RefNumber')
+        txn_date = child_text(fields, 'TxnDate')
+        due_date = child_text(fields, 'DueDate')
+        vendor_elem = fields.get('VendorRef')
         vendor_name = vendor_elem.findtext('FullName', default="") if vendor_elem is not None else ""
-        vendor_address = parse_address(po.find('VendorAddress'))
-        ship_address = parse_address(po.find('ShipAddress'))
-        total_amount = po.findtext('TotalAmount', default="")
-
-        # Find simple line items and grouped line items
-        line_items = po.findall('PurchaseOrderLineRet')
-        group_items = po.findall('PurchaseOrderLineGroupRet')
+        vendor_address = parse_address(fields.get('VendorAddress'))
+        ship_address = parse_address(fields.get('ShipAddress'))
+        total_amount = child_text(fields, 'TotalAmount')
+        # Header columns are the same on every row of this PO, so build them once
+        header = (po_number, vendor_name, txn_date, due_date, vendor_address, ship_address, total_amount)
 
         # If no line items were returned, output a header-only record.
         if not line_items and not group_items:
-            data.append({
-                "PO Number": po_number,
-                "Vendor Name": vendor_name,
-                "Transaction Date": txn_date,
-                "Due Date": due_date,
-                "Vendor Address": vendor_address,
-                "Ship To": ship_address,
-                "Total Amount": total_amount,
-                "Line Description": "",
-                "Quantity": "",
-                "Rate": "",
-                "Amount": "",
-                "Item Ref Full Name": ""
-            })
+            yield header + ("", "", "", "", "")
         else:
             # Process simple PurchaseOrderLineRet items.
             for li in line_items:
-                line_desc = li.findtext('Desc', default="")
-                quantity = li.findtext('Quantity', default="")
-                rate = li.findtext('Rate', default="")
-                amount = li.findtext('Amount', default="")
-                item_ref_elem = li.find('ItemRef')
+                li_fields = {c.tag: c for c in li}
+                line_desc = child_text(li_fields, 'Desc')
+                quantity = child_text(li_fields, 'Quantity')
+                rate = child_text(li_fields, 'Rate')
+                amount = child_text(li_fields, 'Amount')
+                item_ref_elem = li_fields.get('ItemRef')
                 item_full_name = item_ref_elem.findtext('FullName', default="") if item_ref_elem is not None else ""
                 
-                data.append({
-                    "PO Number": po_number,
-                    "Vendor Name": vendor_name,
-                    "Transaction Date": txn_date,
-                    "Due Date": due_date,
-                    "Vendor Address": vendor_address,
-                    "Ship To": ship_address,
-                    "Total Amount": total_amount,
-                    "Line Description": line_desc,
-                    "Quantity": quantity,
-                    "Rate": rate,
-                    "Amount": amount,
-                    "Item Ref Full Name": item_full_name
-                })
+                yield header + (line_desc, quantity, rate, amount, item_full_name)
             # Process grouped line items (PurchaseOrderLineGroupRet)
             for group in group_items:
                 # The group typically includes a description, quantity, and a total amount for the group.
-                line_desc = group.findtext('Desc', default="")
-                quantity = group.findtext('Quantity', default="")
-                amount = group.findtext('TotalAmount', default="")
+                group_fields = {c.tag: c for c in group}
+                line_desc = child_text(group_fields, 'Desc')
+                quantity = child_text(group_fields, 'Quantity')
+                amount = child_text(group_fields, 'TotalAmount')
                 # The item reference for a grouped item is under ItemGroupRef.
-                item_group_elem = group.find('ItemGroupRef')
+                item_group_elem = group_fields.get('ItemGroupRef')
                 item_full_name = item_group_elem.findtext('FullName', default="") if item_group_elem is not None else ""
                 
-                data.append({
-                    "PO Number": po_number,
-                    "Vendor Name": vendor_name,
-                    "Transaction Date": txn_date,
-                    "Due Date": due_date,
-                    "Vendor Address": vendor_address,
-                    "Ship To": ship_address,
-                    "Total Amount": total_amount,
-                    "Line Description": line_desc,
-                    "Quantity": quantity,
-                    "Rate": "",  # Group items generally do not include a per-item rate
-                    "Amount": amount,
-                    "Item Ref Full Name": item_full_name
-                })
-    return data
-
-def export_to_csv(data, filename):
+                # Group items generally do not include a per-item rate
+                yield header + (line_desc, quantity, "", amount, item_full_name)
+
+def export_to_csv(rows, filename, verbose=True, compress=COMPRESS):
+    """
+    Exports the provided rows (any iterable of tuples in column order) to a CSV file.
+    Pass verbose=False to skip the completion message, e.g. when writing many files in a loop.
+    """
+    if compress:
+        filename += ".gz"
+    with open_csv(filename, compress) as csvfile:
+        writer = csv.writer(csvfile)
+        writer.writerow(FIELDNAMES)
+        writer.writerows(rows)
+    if verbose:
+        print(f"Export complete! Data saved to {filename}")
+
+# Queued instead of the None end marker when fetching stops early, so the writer does not
+# report a partial export as complete
+_CANCELLED = object()
+
+def iter_queued(responses):
+    """
+    Yields the (po_numbers, response) batches put on `responses` until the None end marker.
+    Raises if _CANCELLED arrives instead, since some batches were never fetched.
+    """
+    while True:
+        batch = responses.get()
+        if batch is None:
+            return
+        if batch is _CANCELLED:
+            raise RuntimeError("fetching stopped before every purchase order batch was received")
+        yield batch
+
+def export_po_files(batches, total):
     """
-    Exports the provided list of dictionaries (data rows) to a CSV file.
+    Writes one CSV per requested PO from each (po_numbers, response) batch, printing progress
+    once per batch rather than once per PO (console writes are slow on Windows).
+    """
+    written = 0
+    for po_numbers, response in batches:
+        # QuickBooks matches RefNumber case-insensitively, so group the same way
+        rows_by_po = {}
+        for row in iter_po_rows(response):
+            rows_by_po.setdefault(row[0].casefold(), []).append(row)
+        for po in po_numbers:
+            export_to_csv(rows_by_po.get(po.casefold(), []),
+                          filename=f"purchase_order_{po}.csv", verbose=False)
+        written += len(po_numbers)
+        print(f"{written}/{total} POs processed")
+    print(f"Export complete! Data saved to {written} purchase order file(s)")
+
+def main(rp=None, session=None, combined_output=False):
+    """
+    Runs the purchase order export. Pass an open (rp, session) from qb_session to reuse an
+    existing QuickBooks session; otherwise one is opened and closed here.
+    Ctrl+C is passed on to the caller when the session was handed in.
+    With `combined_output`, POs fetched by number go to one CSV instead of one file per PO.
     """
-    fieldnames = [
-        "PO Number",
-        "Vendor Name",
-        "Transaction Date",
-        "Due Date",
-        "Vendor Address",
-        "Ship To",
-        "Total Amount",
-        "Line Description",
-        "Quantity",
-        "Rate",
-        "Amount",
-        "Item Ref Full Name"
-    ]
-    with open(filename, mode="w", newline="", encoding="utf-8") as csvfile:
-        writer = csv.DictWriter(csvfile, fieldnames=fieldnames)
-        writer.writeheader()
-        writer.writerows(data)
-    print(f"Export complete! Data saved to {filename}")
-
-def main():
     choice = input("Fetch by PO numbers (n) or by year (y)? ").strip().lower()
 
-    rp = None
-    session = None
+    owns_session = rp is None
     try:
-        pythoncom.CoInitialize()
-        rp = win32com.client.Dispatch("QBXMLRP2.RequestProcessor")
-        rp.OpenConnection("", "PythonPOQBXMLApp")
-        session = rp.BeginSession("", 2)
-
-        if choice == 'y':
-            year = input("Enter year (e.g. 2023): ").strip()
-            qbxml_request = build_qbxml_year_po_request(year)
-            print(f"\nSending QBXML Request for purchase orders from {year}-01-01 through today...")
-            response = rp.ProcessRequest(session, qbxml_request)
-            data = process_po_response(response)
-            export_to_csv(data, filename=f"purchase_orders_from_{year}.csv")
-
-        elif choice == 'n':
-            po_input = input("Enter comma-separated PO numbers: ").strip()
-            po_numbers = [po.strip() for po in po_input.split(",") if po.strip()]
-            if not po_numbers:
-                print("No PO numbers provided; exiting.")
-            else:
-                for po in po_numbers:
-                    qbxml_request = build_qbxml_po_request(po)
-                    print(f"\nSending QBXML Request for Purchase Order {po}...")
-                    response = rp.ProcessRequest(session, qbxml_request)
-                    data = process_po_response(response)
-                    export_to_csv(data, filename=f"purchase_order_{po}.csv")
+        with (qb_session("PythonPOQBXMLApp") if rp is None else nullcontext((rp, session))) as (rp, session):
+            if choice == 'y':
+                year = input("Enter year (e.g. 2023): ").strip()
+                qbxml_request = build_qbxml_year_po_request(year)
+                print(f"\nSending QBXML Request for purchase orders from {year}-01-01 through today...")
+                response = rp.ProcessRequest(session, qbxml_request)
+                export_to_csv(iter_po_rows(response), filename=f"purchase_orders_from_{year}.csv")
 
-        else:
-            print("Invalid choice; please run again and enter 'n' or 'y'.")
+            elif choice == 'n':
+                po_input = input("Enter comma-separated PO numbers: ").strip()
+                # Drop repeats (case-insensitively, as QuickBooks matches RefNumber) so each PO
+                # is queried and written once; the first spelling entered is kept
+                unique_pos = {}
+                for po in po_input.split(","):
+                    po = po.strip()
+                    if po:
+                        unique_pos.setdefault(po.casefold(), po)
+                po_numbers = list(unique_pos.values())
+                if not po_numbers:
+                    print("No PO numbers provided; exiting.")
+                else:
+                    print(f"\nSending QBXML Requests for {len(po_numbers)} purchase order(s)...")
+                    # Responses are parsed and written on a worker thread while the main thread
+                    # requests the next batch. The worker never touches COM, so the request
+                    # processor stays on this thread.
+                    responses = queue.Queue()
+                    with ThreadPoolExecutor(max_workers=1) as writer:
+                        if combined_output:
+                            # One file and one writer for every batch; rows stream straight through
+                            rows = chain.from_iterable(iter_po_rows(response)
+                                                       for _, response in iter_queued(responses))
+                            writing = writer.submit(export_to_csv, rows, filename="purchase_orders_combined.csv")
+                        else:
+                            writing = writer.submit(export_po_files, iter_queued(responses), len(po_numbers))
+                        finished = False
+                        try:
+                            for start in range(0, len(po_numbers), _PO_BATCH_SIZE):
+                                if writing.done():
+                                    # The writer only finishes early if it failed (e.g. a CSV is open
+                                    # in Excel); stop querying QuickBooks and report its error below
+                                    break
+                                batch = po_numbers[start:start + _PO_BATCH_SIZE]
+                                response = rp.ProcessRequest(session, build_qbxml_multi_po_request(batch))
+                                responses.put((batch, response))
+                            else:
+                                finished = True
+                        finally:
+                            # Let the writer finish what it has even if a request failed; only a
+                            # complete run lets it print its success summary
+                            responses.put(None if finished else _CANCELLED)
+                        try:
+                            writing.result()
+                        except OSError as e:
+                            print("Error writing purchase order CSV:", e)
+
+            else:
+                print("Invalid choice; please run again and enter 'n' or 'y'.")
 
     except KeyboardInterrupt:
+        if not owns_session:
+            raise  # let the caller (e.g. qb_all) stop the whole run, not just this export
         print("\nOperation cancelled by user.")
     except Exception as e:
         print("Error communicating with QuickBooks:", e)
-    finally:
-        # clean up COM session—even if errors or Ctrl+C
-        if rp and session:
-            try: rp.EndSession(session)
-            except: pass
-        if rp:
-            try: rp.CloseConnection()
-            except: pass
-        pythoncom.CoUninitialize()
 
 if __name__ == "__main__":
-    main()
+    main(combined_output="--combined-output" in sys.argv[1:])
@@ -0,0 +1,31 @@
+import win32com.client
+import pythoncom
+from contextlib import contextmanager
+
+@contextmanager
+def qb_session(app_name):
+    """
+    Opens a QuickBooks request processor session and yields (rp, session).
+
+    Connecting and beginning a session is the slowest part of talking to QuickBooks, so
+    scripts accept an existing (rp, session) and qb_all.py runs every export inside one
+    of these. On exit the session is ended, the connection closed and COM uninitialized,
+    even after errors or Ctrl+C.
+    """
+    rp = None
+    session = None
+    pythoncom.CoInitialize()
+    try:
+        rp = win32com.client.Dispatch("QBXMLRP2.RequestProcessor")
+        rp.OpenConnection("", app_name)
+        session = rp.BeginSession("", 2)
+        yield rp, session
+    finally:
+        # clean up COM session—even if errors or Ctrl+C
+        if rp and session:
+            try: rp.EndSession(session)
+            except: pass
+        if rp:
+            try: rp.CloseConnection()
+            except: pass
+        pythoncom.CoUninitialize()
@@ -1,163 +1,201 @@
 import csv
-import xml.etree.ElementTree as ET
-import win32com.client
+import os
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import nullcontext
+from operator import itemgetter
 import pythoncom
 from datetime import datetime
+from qb_csv import open_csv
+from qb_session import qb_session
+from qb_xml import iter_records
+from xml.sax.saxutils import escape
 
-def build_qbxml_customers_request(iterator_mode, iterator_id=None):
+# Set QB_DEBUG=1 to save the first raw batch to debug_first_batch.xml
+DEBUG = bool(os.environ.get("QB_DEBUG"))
+# Set QB_GZIP=1 to write exports as gzip-compressed .csv.gz files
+COMPRESS = bool(os.environ.get("QB_GZIP"))
+
+FIELDNAMES = ('Customer', 'ShipToName', 'Addr1', 'Addr2', 'Addr3', 'Addr4', 'Addr5',
+              'City', 'State', 'PostalCode', 'Country', 'Note', 'DefaultShipTo')
+
+# ShipToAddress child tags, in the same order as FIELDNAMES[1:]
+_SHIPTO_TAGS = ('Name', 'Addr1', 'Addr2', 'Addr3', 'Addr4', 'Addr5',
+                'City', 'State', 'PostalCode', 'Country', 'Note', 'DefaultShipTo')
+
+# Customers per iterator page. Each page is a full COM round-trip, so fewer, larger pages
+# are cheaper; main() halves this if QuickBooks refuses the opening request.
+MAX_RETURNED = 500
+
+# Request envelope is built once at import; only the iterator attributes and page size vary per call.
+_CUSTOMER_QUERY_TPL = (
+    '<?xml version="1.0" encoding="utf-8"?>\n'
+    '<?qbxml version="16.0"?>\n'
+    '<QBXML>\n'
+    '  <QBXMLMsgsRq onError="continueOnError">\n'
+    '    <CustomerQueryRq requestID="1"%s>\n'
+    '      <MaxReturned>%d</MaxReturned>\n'
+    '    </CustomerQueryRq>\n'
+    '  </QBXMLMsgsRq>\n'
+    '</QBXML>'
+)
+
+def build_qbxml_customers_request(iterator_mode, iterator_id=None, max_returned=MAX_RETURNED):
     # Build CustomerQueryRq WITHOUT IncludeRetElement to get all fields including ShipToAddress
     iterator_attr = f' iterator="{iterator_mode}"'
     if iterator_id:
-        iterator_attr += f' iteratorID="{iterator_id}"'
+        iterator_attr += f' iteratorID="{escape(iterator_id, {chr(34): "&quot;"})}"'
     
     # Don't use IncludeRetElement - let QB return all fields including ShipToAddress
-    qbxml = (
-        '<?xml version="1.0" encoding="utf-8"?>\n'
-        '<?qbxml version="16.0"?>\n'
-        '<QBXML>\n'
-        '  <QBXMLMsgsRq onError="continueOnError">\n'
-        f'    <CustomerQueryRq requestID="1"{iterator_attr}>\n'
-        '      <MaxReturned>100</MaxReturned>\n'
-        '    </CustomerQueryRq>\n'
-        '  </QBXMLMsgsRq>\n'
-        '</QBXML>'
-    )
-    return qbxml
+    return _CUSTOMER_QUERY_TPL % (iterator_attr, max_returned)
+
+def read_iterator_state(response_xml):
+    # Return (iterator_id, remaining) from the CustomerQueryRs start tag. Parsing stops right
+    # there, so this only reads the head of the response.
+    for rs in iter_records(response_xml, start_tags=('CustomerQueryRs',)):
+        return rs.get('iteratorID'), int(rs.get('iteratorRemainingCount') or 0)
+    return None, 0
 
 def parse_shipto(response_xml):
-    # Extract customer names and their ShipToAddress entries
-    root = ET.fromstring(response_xml)
+    # Extract customer names and their ShipToAddress entries in a single streaming pass.
+    # Returns (records, customer_count); see read_iterator_state for the paging attributes.
     records = []
+    customer_count = 0
     
-    for cust in root.findall('.//CustomerRet'):
-        name = cust.findtext('FullName', '').strip()
-        
-        # Look for ShipToAddress elements directly under CustomerRet
-        ship_addresses = cust.findall('ShipToAddress')
+    for cust in iter_records(response_xml, 'CustomerRet'):
+        customer_count += 1
+        # Walk the children once, picking up the name and the ShipToAddress elements
+        name = ''
+        ship_addresses = []
+        for child in cust:
+            if child.tag == 'ShipToAddress':
+                ship_addresses.append(child)
+            elif child.tag == 'FullName':
+                name = (child.text or '').strip()
         
         for st in ship_addresses:
-            # Extract each field separately
-            record = {
-                'Customer': name,
-                'ShipToName': st.findtext('Name', '').strip(),
-                'Addr1': st.findtext('Addr1', '').strip(),
-                'Addr2': st.findtext('Addr2', '').strip(),
-                'Addr3': st.findtext('Addr3', '').strip(),
-                'Addr4': st.findtext('Addr4', '').strip(),
-                'Addr5': st.findtext('Addr5', '').strip(),
-                'City': st.findtext('City', '').strip(),
-                'State': st.findtext('State', '').strip(),
-                'PostalCode': st.findtext('PostalCode', '').strip(),
-                'Country': st.findtext('Country', '').strip(),
-                'Note': st.findtext('Note', '').strip(),
-                'DefaultShipTo': st.findtext('DefaultShipTo', '').strip()
-            }
+            # Index the address fields once, then lay them out in FIELDNAMES order
+            fields = {c.tag: (c.text or '').strip() for c in st}
+            record = (name,) + tuple(fields.get(tag, '') for tag in _SHIPTO_TAGS)
             
-            # Only add if there's at least some address data
-            if any([record['ShipToName'], record['Addr1'], record['City']]):
+            # Only add if there's at least some address data (ShipToName, Addr1 or City)
+            if record[1] or record[2] or record[7]:
                 records.append(record)
     
-    return records
+    return records, customer_count
 
-def export_to_csv(records, filename="shipto_addresses.csv", exclude_empty_columns=True):
+def export_to_csv(records, filename="shipto_addresses.csv", exclude_empty_columns=True, compress=COMPRESS):
     # Write out to CSV with timestamp
     timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
     filename_with_time = f"shipto_addresses_{timestamp}.csv"
+    if compress:
+        filename_with_time += ".gz"
     
     if records:
-        # Define all possible columns
-        all_columns = ['Customer', 'ShipToName', 'Addr1', 'Addr2', 'Addr3', 'Addr4', 'Addr5', 
-                      'City', 'State', 'PostalCode', 'Country', 'Note', 'DefaultShipTo']
-        
         if exclude_empty_columns:
-            # Find columns that have at least one non-empty value
-            columns_with_data = []
-            for col in all_columns:
-                if any(record.get(col, '') for record in records):
-                    columns_with_data.append(col)
-            columns = columns_with_data
+            # Keep only columns that have at least one non-empty value. One pass over the
+            # records, stopping early once every column has been seen with data.
+            present = [False] * len(FIELDNAMES)
+            for record in records:
+                for i, value in enumerate(record):
+                    if value and not present[i]:
+                        present[i] = True
+                if all(present):
+                    break
+            keep_idx = [i for i, p in enumerate(present) if p]
+            columns = [FIELDNAMES[i] for i in keep_idx]
             print(f"Including columns: {', '.join(columns)}")
+            project = itemgetter(*keep_idx)
+            # itemgetter returns a bare value rather than a tuple for a single index
+            rows = map(project, records) if len(keep_idx) > 1 else ((project(r),) for r in records)
         else:
-            columns = all_columns
+            columns = FIELDNAMES
+            rows = records
         
-        with open(filename_with_time, 'w', newline='', encoding='utf-8') as f:
-            writer = csv.DictWriter(f, fieldnames=columns, extrasaction='ignore')
-            writer.writeheader()
-            writer.writerows(records)
+        with open_csv(filename_with_time, compress) as f:
+            writer = csv.writer(f)
+            writer.writerow(columns)
+            writer.writerows(rows)
         
         print(f"✅ Exported {len(records)} records to {filename_with_time}")
         
         # Show summary of address usage
         print("\nAddress field usage summary:")
         for col in ['Addr1', 'Addr2', 'Addr3', 'Addr4', 'Addr5']:
-            count = sum(1 for r in records if r.get(col, ''))
+            i = FIELDNAMES.index(col)
+            count = sum(1 for r in records if r[i])
             if count > 0:
                 print(f"  {col}: {count} addresses use this line")
     else:
         print("No records to export")
 
-def main():
+def main(rp=None, session=None):
+    """
+    Runs the ship-to export. Pass an open (rp, session) from qb_session to reuse an
+    existing QuickBooks session; otherwise one is opened and closed here.
+    """
     print("=== QuickBooks ShipTo Address Exporter ===")
     print(f"Started at: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}\n")
     
-    # Initialize COM and QuickBooks session
-    pythoncom.CoInitialize()
-    rp = win32com.client.Dispatch("QBXMLRP2.RequestProcessor")
-    rp.OpenConnection("", "QB ShipTo Exporter")
-    session = rp.BeginSession("", 2)
-    
     all_records = []
     iterator_id = None
     batch_count = 0
     total_customers = 0
+    max_returned = MAX_RETURNED
+    pending = []
     
     try:
-        while True:
-            batch_count += 1
-            mode = 'Start' if iterator_id is None else 'Continue'
-            qbxml = build_qbxml_customers_request(mode, iterator_id)
-            
-            print(f"Processing batch {batch_count}...")
-            response = rp.ProcessRequest(session, qbxml)
-            
-            # Debug: save first batch response
-            if batch_count == 1:
-                with open('debug_first_batch.xml', 'w', encoding='utf-8') as f:
-                    f.write(response)
-                print("Saved first batch to debug_first_batch.xml for inspection")
+        # Batches are parsed on a worker thread while the main thread fetches the next page.
+        # The worker never touches COM, so the request processor stays on this thread.
+        with ThreadPoolExecutor(max_workers=1) as parser, \
+                (qb_session("QB ShipTo Exporter") if rp is None else nullcontext((rp, session))) as (rp, session):
+            while True:
+                batch_count += 1
+                mode = 'Start' if iterator_id is None else 'Continue'
+                qbxml = build_qbxml_customers_request(mode, iterator_id, max_returned)
             
-            # Parse the response
-            root = ET.fromstring(response)
-            customers = root.findall('.//CustomerRet')
-            total_customers += len(customers)
+                print(f"Processing batch {batch_count}...")
+                try:
+                    response = rp.ProcessRequest(session, qbxml)
+                except pythoncom.com_error:
+                    # Some QB installs refuse large pages; shrink the page and retry the opening request
+                    if iterator_id is not None or max_returned <= 100:
+                        raise
+                    max_returned = max(max_returned // 2, 100)
+                    print(f"  QuickBooks rejected the request; retrying with MaxReturned={max_returned}")
+                    batch_count -= 1
+                    continue
             
-            # Extract ShipTo addresses
-            records = parse_shipto(response)
-            all_records.extend(records)
+                # Debug: save first batch response
+                if DEBUG and batch_count == 1:
+                    with open('debug_first_batch.xml', 'w', encoding='utf-8') as f:
+                        f.write(response)
+                    print("Saved first batch to debug_first_batch.xml for inspection")
             
-            print(f"  Found {len(customers)} customers, {len(records)} ShipTo addresses")
+                # Hand the batch to the parser; only the iterator state is needed here
+                response = response.encode('utf-8')
+                pending.append(parser.submit(parse_shipto, response))
+                next_iterator_id, remaining = read_iterator_state(response)
             
-            # Check iteratorRemainingCount
-            rs = root.find('.//CustomerQueryRs')
-            if rs is None or rs.get('iteratorRemainingCount') in (None, '0'):
-                break
-            iterator_id = rs.get('iteratorID')
+                # Check iteratorRemainingCount
+                if not remaining:
+                    break
+                iterator_id = next_iterator_id
             
     except Exception as e:
         print(f"Error: {e}")
         import traceback
         traceback.print_exc()
-        
-    finally:
-        try:
-            rp.EndSession(session)
-        except:
-            pass
+    
+    # Collect parsed batches in request order
+    for batch, future in enumerate(pending, 1):
         try:
-            rp.CloseConnection()
-        except:
-            pass
-        pythoncom.CoUninitialize()
+            records, customer_count = future.result()
+        except Exception as e:
+            print(f"Error parsing batch {batch}: {e}")
+            continue
+        total_customers += customer_count
+        all_records.extend(records)
+        print(f"  Batch {batch}: {customer_count} customers, {len(records)} ShipTo addresses")
     
     print(f"\n{'='*50}")
     print(f"Processed {total_customers} total customers")
@@ -167,6 +205,7 @@ def main():
         # Show sample of data
         print(f"\nSample data (first 3 records):")
         for i, record in enumerate(all_records[:3]):
+            record = dict(zip(FIELDNAMES, record))
             print(f"  {i+1}. {record['Customer']} -> {record['ShipToName']} ({record['City']}, {record['State']})")
         
         # Export with option to exclude empty columns (default: True)
@@ -176,7 +215,7 @@ def main():
         print("This could mean:")
         print("  1. Your customers don't have ShipTo addresses defined")
         print("  2. Only the default ShipAddress is used (not ShipToAddress)")
-        print("\nCheck debug_first_batch.xml to see the actual customer data structure")
+        print("\nRe-run with QB_DEBUG=1 and check debug_first_batch.xml to see the actual customer data structure")
 
 if __name__ == '__main__':
     main()
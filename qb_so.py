@@ -1,67 +1,90 @@
 import csv
-import xml.etree.ElementTree as ET
-import win32com.client
-import pythoncom
+import os
+import sys
+from contextlib import nullcontext
 from datetime import date
-
-def build_qbxml_so_request(so_number):
-    """SalesOrderQuery filtered by a single SO number."""
-    return (
-        '<?xml version="1.0" encoding="utf-8"?>\n'
-        '<?qbxml version="16.0"?>\n'
-        '<QBXML>\n'
-        '  <QBXMLMsgsRq onError="continueOnError">\n'
-        f'    <SalesOrderQueryRq requestID="1">\n'
-        f'      <RefNumber>{so_number}</RefNumber>\n'
-        '      <IncludeLineItems>1</IncludeLineItems>\n'
-        '    </SalesOrderQueryRq>\n'
-        '  </QBXMLMsgsRq>\n'
-        '</QBXML>'
-    )
+from qb_csv import open_csv
+from qb_session import qb_session
+from qb_xml import iter_records, child_text, parse_address
+from xml.sax.saxutils import escape
+
+# Set QB_DEBUG=1 to echo generated QBXML (e.g. for validation in qbValidator.exe)
+DEBUG = bool(os.environ.get("QB_DEBUG"))
+# Set QB_GZIP=1 to write exports as gzip-compressed .csv.gz files
+COMPRESS = bool(os.environ.get("QB_GZIP"))
+
+FIELDNAMES = (
+    "SO Number",
+    "Customer Name",
+    "Transaction Date",
+    "Due Date",
+    "Bill To",
+    "Ship To",
+    "Subtotal",
+    "Sales Tax Total",
+    "Total Amount",
+    "Line Description",
+    "Quantity",
+    "Rate",
+    "Amount",
+    "Item Ref Full Name"
+)
+
+# These scripts run once per invocation, so "today" is fixed at import
+_TODAY_ISO = date.today().isoformat()
+
+# Request envelopes are built once at import; builders only fill in the %s slots.
+_SO_QUERY_TPL = (
+    '<?xml version="1.0" encoding="utf-8"?>\n'
+    '<?qbxml version="16.0"?>\n'
+    '<QBXML>\n'
+    '  <QBXMLMsgsRq onError="continueOnError">\n'
+    '    <SalesOrderQueryRq requestID="1">\n'
+    '%s'
+    '      <IncludeLineItems>1</IncludeLineItems>\n'
+    '    </SalesOrderQueryRq>\n'
+    '  </QBXMLMsgsRq>\n'
+    '</QBXML>'
+)
+
+_YEAR_SO_QUERY_TPL = (
+    '<?xml version="1.0" encoding="utf-8"?>\n'
+    '<?qbxml version="16.0"?>\n'
+    '<QBXML>\n'
+    '  <QBXMLMsgsRq onError="continueOnError">\n'
+    '    <SalesOrderQueryRq requestID="1">\n'
+    '      <TxnDateRangeFilter>\n'
+    '        <FromTxnDate>%s</FromTxnDate>\n'
+    '        <ToTxnDate>%s</ToTxnDate>\n'
+    '      </TxnDateRangeFilter>\n'
+    '      <IncludeLineItems>1</IncludeLineItems>\n'
+    '    </SalesOrderQueryRq>\n'
+    '  </QBXMLMsgsRq>\n'
+    '</QBXML>'
+)
+
+def build_qbxml_so_request(so_numbers):
+    """SalesOrderQuery filtered by one or more SO numbers, answered in a single round-trip."""
+    ref_numbers = "".join(f'      <RefNumber>{escape(n)}</RefNumber>\n' for n in so_numbers)
+    return _SO_QUERY_TPL % ref_numbers
 
 def build_qbxml_year_so_request(year):
     """
     SalesOrderQueryRq that returns every SO from Jan 1 of `year` through today,
     with line items included. Filter must appear before IncludeLineItems.
     """
-    from_date = f"{year}-01-01"
-    to_date   = date.today().isoformat()
-
-    qbxml = (
-        '<?xml version="1.0" encoding="utf-8"?>\n'
-        '<?qbxml version="16.0"?>\n'
-        '<QBXML>\n'
-        '  <QBXMLMsgsRq onError="continueOnError">\n'
-        '    <SalesOrderQueryRq requestID="1">\n'
-        '      <TxnDateRangeFilter>\n'
-        f'        <FromTxnDate>{from_date}</FromTxnDate>\n'
-        f'        <ToTxnDate>{to_date}</ToTxnDate>\n'
-        '      </TxnDateRangeFilter>\n'
-        '      <IncludeLineItems>1</IncludeLineItems>\n'
-        '    </SalesOrderQueryRq>\n'
-        '  </QBXMLMsgsRq>\n'
-        '</QBXML>'
-    )
-    print("DEBUG: Generated QBXML:\n", qbxml)  # for validation in qbValidator.exe
+    from_date = escape(f"{year}-01-01")
+    to_date   = _TODAY_ISO
+
+    qbxml = _YEAR_SO_QUERY_TPL % (from_date, to_date)
+    if DEBUG:
+        print("DEBUG: Generated QBXML:\n", qbxml)  # for validation in qbValidator.exe
     return qbxml
 
-def parse_address(address_element):
-    """
-    Helper function to parse an address block from QBXML.
-    Concatenates common address fields (for example, Addr1, City, State, etc.) into a single string.
-    """
-    if address_element is None:
-        return ""
-    parts = []
-    for tag in ["Addr1", "Addr2", "Addr3", "Addr4", "Addr5", "City", "State", "PostalCode", "Country"]:
-        text = address_element.findtext(tag, "").strip()
-        if text:
-            parts.append(text)
-    return ", ".join(parts)
-
-def process_so_response(response_xml):
+def iter_so_rows(response_xml):
     """
-    Parses the QBXML response for sales orders and returns a list of dictionaries for CSV export.
+    Parses the QBXML response for sales orders and yields row tuples (in FIELDNAMES order) for CSV export.
+    Rows are produced as each SalesOrderRet is parsed, so they can be written out without collecting them first.
 
     For each sales order (SalesOrderRet element) extracted, it collects header information:
       - Sales Order Number (RefNumber)
@@ -83,173 +106,138 @@ def process_so_response(response_xml):
 
     If no line items are found, a single row is created with blank details for the line items.
     """
-    root = ET.fromstring(response_xml)
-    sos = root.findall('.//SalesOrderRet')
-    data = []
-    
-    for so in sos:
+    for so in iter_records(response_xml, 'SalesOrderRet'):
+        # Index the children in one pass, splitting out simple and grouped line items
+        fields = {}
+        line_items = []
+        group_items = []
+        for child in so:
+            if child.tag == 'SalesOrderLineRet':
+                line_items.append(child)
+            elif child.tag == 'SalesOrderLineGroupRet':
+                group_items.append(child)
+            else:
+                fields[child.tag] = child
+
         # Header fields
-        so_number = so.findtext('RefNumber', default="")
-        txn_date = so.findtext('TxnDate', default="")
-        due_date = so.findtext('DueDate', default="")
-        customer_elem = so.find('CustomerRef')
+        so_number = child_text(fields, 'RefNumber')
+        txn_date = child_text(fields, 'TxnDate')
+        due_date = child_text(fields, 'DueDate')
+        customer_elem = fields.get('CustomerRef')
         customer_name = customer_elem.findtext('FullName', default="") if customer_elem is not None else ""
-        bill_address = parse_address(so.find('BillAddress'))
-        ship_address = parse_address(so.find('ShipAddress'))
-        total_amount = so.findtext('TotalAmount', default="")
-        sales_tax_total = so.findtext('SalesTaxTotal', default="")
-        subtotal = so.findtext('Subtotal', default="")
-
-        # Find simple line items and grouped line items
-        line_items = so.findall('SalesOrderLineRet')
-        group_items = so.findall('SalesOrderLineGroupRet')
+        bill_address = parse_address(fields.get('BillAddress'))
+        ship_address = parse_address(fields.get('ShipAddress'))
+        total_amount = child_text(fields, 'TotalAmount')
+        sales_tax_total = child_text(fields, 'SalesTaxTotal')
+        subtotal = child_text(fields, 'Subtotal')
+
+        # The same customers, addresses and dates recur across sales orders; intern them so
+        # rows held in memory share one copy of each string
+        customer_name = sys.intern(customer_name)
+        txn_date = sys.intern(txn_date)
+        due_date = sys.intern(due_date)
+        bill_address = sys.intern(bill_address)
+        ship_address = sys.intern(ship_address)
 
         # If no line items were returned, output a header-only record.
         if not line_items and not group_items:
-            data.append({
-                "SO Number": so_number,
-                "Customer Name": customer_name,
-                "Transaction Date": txn_date,
-                "Due Date": due_date,
-                "Bill To": bill_address,
-                "Ship To": ship_address,
-                "Subtotal": subtotal,
-                "Sales Tax Total": sales_tax_total,
-                "Total Amount": total_amount,
-                "Line Description": "",
-                "Quantity": "",
-                "Rate": "",
-                "Amount": "",
-                "Item Ref Full Name": ""
-            })
+            yield (
+                so_number, customer_name, txn_date, due_date, bill_address, ship_address,
+                subtotal, sales_tax_total, total_amount,
+                "", "", "", "", ""
+            )
         else:
             # Process simple SalesOrderLineRet items.
             for li in line_items:
-                line_desc = li.findtext('Desc', default="")
-                quantity = li.findtext('Quantity', default="")
-                rate = li.findtext('Rate', default="")
-                amount = li.findtext('Amount', default="")
-                item_ref_elem = li.find('ItemRef')
+                li_fields = {c.tag: c for c in li}
+                line_desc = child_text(li_fields, 'Desc')
+                quantity = child_text(li_fields, 'Quantity')
+                rate = child_text(li_fields, 'Rate')
+                amount = child_text(li_fields, 'Amount')
+                item_ref_elem = li_fields.get('ItemRef')
                 item_full_name = item_ref_elem.findtext('FullName', default="") if item_ref_elem is not None else ""
                 
-                data.append({
-                    "SO Number": so_number,
-                    "Customer Name": customer_name,
-                    "Transaction Date": txn_date,
-                    "Due Date": due_date,
-                    "Bill To": bill_address,
-                    "Ship To": ship_address,
-                    "Subtotal": subtotal,
-                    "Sales Tax Total": sales_tax_total,
-                    "Total Amount": total_amount,
-                    "Line Description": line_desc,
-                    "Quantity": quantity,
-                    "Rate": rate,
-                    "Amount": amount,
-                    "Item Ref Full Name": item_full_name
-                })
+                yield (
+                    so_number, customer_name, txn_date, due_date, bill_address, ship_address,
+                    subtotal, sales_tax_total, total_amount,
+                    line_desc, quantity, rate, amount, item_full_name
+                )
             # Process grouped line items (SalesOrderLineGroupRet)
             for group in group_items:
                 # The group typically includes a description, quantity, and a total amount for the group.
-                line_desc = group.findtext('Desc', default="")
-                quantity = group.findtext('Quantity', default="")
-                amount = group.findtext('TotalAmount', default="")
+                group_fields = {c.tag: c for c in group}
+                line_desc = child_text(group_fields, 'Desc')
+                quantity = child_text(group_fields, 'Quantity')
+                amount = child_text(group_fields, 'TotalAmount')
                 # The item reference for a grouped item is under ItemGroupRef.
-                item_group_elem = group.find('ItemGroupRef')
+                item_group_elem = group_fields.get('ItemGroupRef')
                 item_full_name = item_group_elem.findtext('FullName', default="") if item_group_elem is not None else ""
                 
-                data.append({
-                    "SO Number": so_number,
-                    "Customer Name": customer_name,
-                    "Transaction Date": txn_date,
-                    "Due Date": due_date,
-                    "Bill To": bill_address,
-                    "Ship To": ship_address,
-                    "Subtotal": subtotal,
-                    "Sales Tax Total": sales_tax_total,
-                    "Total Amount": total_amount,
-                    "Line Description": line_desc,
-                    "Quantity": quantity,
-                    "Rate": "",  # Group items generally do not include a per-item rate
-                    "Amount": amount,
-                    "Item Ref Full Name": item_full_name
-                })
-    return data
-
-def export_to_csv(data, filename):
+                yield (
+                    so_number, customer_name, txn_date, due_date, bill_address, ship_address,
+                    subtotal, sales_tax_total, total_amount,
+                    line_desc, quantity,
+                    "",  # Group items generally do not include a per-item rate
+                    amount, item_full_name
+                )
+
+def export_to_csv(rows, filename, compress=COMPRESS):
     """
-    Exports the provided list of dictionaries (data rows) to a CSV file.
+    Exports the provided rows (any iterable of tuples in FIELDNAMES order) to a CSV file.
+    With `compress`, the file is gzipped and ".gz" is appended to `filename`.
     """
-    fieldnames = [
-        "SO Number",
-        "Customer Name",
-        "Transaction Date",
-        "Due Date",
-        "Bill To",
-        "Ship To",
-        "Subtotal",
-        "Sales Tax Total",
-        "Total Amount",
-        "Line Description",
-        "Quantity",
-        "Rate",
-        "Amount",
-        "Item Ref Full Name"
-    ]
-    with open(filename, mode="w", newline="", encoding="utf-8") as csvfile:
-        writer = csv.DictWriter(csvfile, fieldnames=fieldnames)
-        writer.writeheader()
-        writer.writerows(data)
+    if compress:
+        filename += ".gz"
+    with open_csv(filename, compress) as csvfile:
+        writer = csv.writer(csvfile)
+        writer.writerow(FIELDNAMES)
+        writer.writerows(rows)
     print(f"Export complete! Data saved to {filename}")
 
-def main():
+def main(rp=None, session=None):
+    """
+    Runs the sales order export. Pass an open (rp, session) from qb_session to reuse an
+    existing QuickBooks session; otherwise one is opened and closed here.
+    Ctrl+C is passed on to the caller when the session was handed in.
+    """
     choice = input("Fetch by SO numbers (n) or by year (y)? ").strip().lower()
 
-    rp = None
-    session = None
+    owns_session = rp is None
     try:
-        pythoncom.CoInitialize()
-        rp = win32com.client.Dispatch("QBXMLRP2.RequestProcessor")
-        rp.OpenConnection("", "PythonSOQBXMLApp")
-        session = rp.BeginSession("", 2)
-
-        if choice == 'y':
-            year = input("Enter year (e.g. 2023): ").strip()
-            qbxml_request = build_qbxml_year_so_request(year)
-            print(f"\nSending QBXML Request for sales orders from {year}-01-01 through today...")
-            response = rp.ProcessRequest(session, qbxml_request)
-            data = process_so_response(response)
-            export_to_csv(data, filename=f"sales_orders_from_{year}.csv")
-
-        elif choice == 'n':
-            so_input = input("Enter comma-separated SO numbers: ").strip()
-            so_numbers = [so.strip() for so in so_input.split(",") if so.strip()]
-            if not so_numbers:
-                print("No SO numbers provided; exiting.")
-            else:
-                for so in so_numbers:
-                    qbxml_request = build_qbxml_so_request(so)
-                    print(f"\nSending QBXML Request for Sales Order {so}...")
+        with (qb_session("PythonSOQBXMLApp") if rp is None else nullcontext((rp, session))) as (rp, session):
+            if choice == 'y':
+                year = input("Enter year (e.g. 2023): ").strip()
+                qbxml_request = build_qbxml_year_so_request(year)
+                print(f"\nSending QBXML Request for sales orders from {year}-01-01 through today...")
+                response = rp.ProcessRequest(session, qbxml_request)
+                export_to_csv(iter_so_rows(response), filename=f"sales_orders_from_{year}.csv")
+
+            elif choice == 'n':
+                so_input = input("Enter comma-separated SO numbers: ").strip()
+                so_numbers = [so.strip() for so in so_input.split(",") if so.strip()]
+                if not so_numbers:
+                    print("No SO numbers provided; exiting.")
+                else:
+                    qbxml_request = build_qbxml_so_request(so_numbers)
+                    print(f"\nSending QBXML Request for {len(so_numbers)} sales order(s)...")
                     response = rp.ProcessRequest(session, qbxml_request)
-                    data = process_so_response(response)
-                    export_to_csv(data, filename=f"sales_order_{so}.csv")
 
-        else:
-            print("Invalid choice; please run again and enter 'n' or 'y'.")
+                    # QuickBooks matches RefNumber case-insensitively, so group the same way
+                    rows_by_so = {}
+                    for row in iter_so_rows(response):
+                        rows_by_so.setdefault(row[0].casefold(), []).append(row)
+                    for so in so_numbers:
+                        export_to_csv(rows_by_so.get(so.casefold(), []), filename=f"sales_order_{so}.csv")
+
+            else:
+                print("Invalid choice; please run again and enter 'n' or 'y'.")
 
     except KeyboardInterrupt:
+        if not owns_session:
+            raise  # let the caller (e.g. qb_all) stop the whole run, not just this export
         print("\nOperation cancelled by user.")
     except Exception as e:
         print("Error communicating with QuickBooks:", e)
-    finally:
-        # clean up COM session—even if errors or Ctrl+C
-        if rp and session:
-            try: rp.EndSession(session)
-            except: pass
-        if rp:
-            try: rp.CloseConnection()
-            except: pass
-        pythoncom.CoUninitialize()
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,69 @@
+from io import BytesIO
+try:
+    from lxml import etree
+    _HAVE_LXML = True
+except ImportError:
+    import xml.etree.ElementTree as etree
+    _HAVE_LXML = False
+
+_ADDR_TAGS = ("Addr1","Addr2","Addr3","Addr4","Addr5","City","State","PostalCode","Country")
+
+def iter_records(response_xml, *tags, start_tags=()):
+    """
+    Streams the QBXML response and yields each element named in `tags` as soon as it closes.
+    Once the caller moves on, the element is cleared and detached from its parent so only
+    one record is held in memory at a time.
+    `response_xml` may be str (as returned by ProcessRequest) or already-encoded UTF-8 bytes.
+    Elements named in `start_tags` are yielded as soon as they open instead; only their
+    attributes are available at that point.
+    """
+    if isinstance(response_xml, str):
+        response_xml = response_xml.encode('utf-8')
+    if _HAVE_LXML:
+        # libxml2 filters events by tag in C, so only the elements asked for reach Python.
+        # huge_tree lifts libxml2's size limits, which year-range responses can exceed.
+        events = ('start', 'end') if start_tags else ('end',)
+        for event, elem in etree.iterparse(BytesIO(response_xml), events=events,
+                                           tag=tags + tuple(start_tags), huge_tree=True):
+            if event == 'start':
+                if elem.tag in start_tags:
+                    yield elem
+            elif elem.tag in tags:
+                yield elem
+                elem.clear()
+                while elem.getprevious() is not None:
+                    del elem.getparent()[0]
+        return
+    parents = []
+    for event, elem in etree.iterparse(BytesIO(response_xml), events=('start', 'end')):
+        if event == 'start':
+            parents.append(elem)
+            if elem.tag in start_tags:
+                yield elem
+            continue
+        parents.pop()
+        if elem.tag in tags:
+            yield elem
+            elem.clear()
+            if parents:
+                parents[-1].remove(elem)
+
+def child_text(fields, tag):
+    """
+    Returns the text of child `tag` from a {tag: element} index, or "" if it is missing.
+    Records are indexed once so each field lookup is a dict hit instead of a child scan.
+    """
+    elem = fields.get(tag)
+    return "" if elem is None else (elem.text or "")
+
+def parse_address(address_element):
+    """
+    Helper function to parse an address block from QBXML.
+    Concatenates common address fields (for example, Addr1, City, State, etc.) into a single string.
+    """
+    # Empty address blocks (no child elements) are common; skip the indexing for them
+    if address_element is None or len(address_element) == 0:
+        return ""
+    # Index only children that carry text; strip just the ones that end up in the address
+    fields = {c.tag: c.text for c in address_element if c.text}
+    return ", ".join(text for text in (fields.get(tag, "").strip() for tag in _ADDR_TAGS) if text)